@@ -4,7 +4,7 @@ Raspberry Pi Zero 2 W - HTTP Web Server with USB Serial Communication
 Serves a webpage accessible at http://<ip_address>/vex
 
 Requirements:
-    pip install flask pyserial
+    pip install flask flask-compress pyserial waitress orjson pyudev
 
 Run with:
     sudo python3 zero2w_webserver.py
@@ -14,15 +14,18 @@ Access from browser:
 """
 
 import os
+import selectors
 import socket
 import threading
 import time
-from collections import deque
-from flask import Flask, render_template, jsonify, request
+import orjson
+from flask import Flask, Response, g, redirect, render_template, request
+from flask_compress import Compress
+from waitress import serve
 
 # Serial communication
 import serial
-import glob
+import pyudev
 
 # Get the directory where this script is located (for systemd compatibility)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -36,36 +39,129 @@ PORT = 80         # HTTP default port (requires sudo on Linux)
 # USB Serial Configuration
 # VEX Brain always appears as the 2nd /dev/ttyACM* device
 USB_BAUD_RATE = 115200
-RECONNECT_INTERVAL = 2  # Seconds between reconnection attempts
+RECONNECT_INTERVAL = 2  # Seconds between connection re-checks, and open retries when the VEX ports exist
+PARTIAL_LINE_TIMEOUT = 1  # Seconds of silence before an unterminated line is shown
+
+# Web server threads
+# Every open /vex page parks one thread in /api/receive for up to LONG_POLL_TIMEOUT
+# seconds. Waitress cannot tell when a client goes away, so a reloaded or closed tab
+# keeps its thread until the timeout. MAX_LONG_POLL_CLIENTS is the number of open or
+# just-abandoned pages served without queuing. More than that within
+# LONG_POLL_TIMEOUT makes /vex and /api/send wait for a free thread.
+LONG_POLL_TIMEOUT = 10      # Max seconds /api/receive waits for new messages
+MAX_LONG_POLL_CLIENTS = 12
+WEB_THREADS = MAX_LONG_POLL_CLIENTS + 4  # Spare threads for page loads and /api/send
 
 # ==================== GLOBALS ====================
 serial_port = None
 current_usb_port = None  # Track the currently connected port
-received_messages = deque(maxlen=100)  # Store last 100 received messages
-serial_lock = threading.Lock()
+tx_fd = None  # Raw fd of serial_port, cached for os.write on the TX path
+tx_lock = threading.Lock()  # Held while writing to tx_fd and while closing the port
+connected = False  # True while serial_port is open; saves is_open lookups
+acm_ports_present = False  # Last scan found the VEX ports (so a failed open is worth retrying)
+# Received messages live in a fixed ring of parallel arrays (no per-message dict)
+MSG_RING_SIZE = 128  # Must be a power of two
+MSG_RING_MASK = MSG_RING_SIZE - 1
+msg_ids = [0] * MSG_RING_SIZE
+msg_texts = [None] * MSG_RING_SIZE
+msg_timestamps = [None] * MSG_RING_SIZE
+msg_top = 0    # Next slot to write
+msg_count = 0  # Number of filled slots
+RX_BUF_SIZE = 4096  # Read size, and cap on a pending line without a newline
+RX_VIEW = memoryview(bytearray(RX_BUF_SIZE))  # Preallocated target for serial reads
+rx_accum = bytearray()  # Bytes read from serial but not yet terminated by a newline
+new_msg_cond = threading.Condition()  # Wakes long-polling /api/receive requests
+# Pre-serialized JSON bodies for the idle paths, keyed by (usb_connected, usb_port)
+idle_receive_cache = (None, b'')
+status_cache = (None, b'')
+vex_page_cache = {}  # Rendered /vex HTML, keyed by (usb_connected, usb_port)
+VEX_PAGE_CACHE_MAX = 4
 running = True
+udev_context = pyudev.Context()  # Used to enumerate and watch ttyACM devices
 
 # ==================== FLASK APP ====================
 app = Flask(__name__, template_folder=os.path.join(SCRIPT_DIR, 'templates'))
 
+# Gzip responses over Wi-Fi: level 1 is cheapest on the Pi's CPU and still
+# shrinks the repetitive VEX text several-fold (tiny idle replies are skipped)
+app.config['COMPRESS_ALGORITHM'] = 'gzip'
+app.config['COMPRESS_LEVEL'] = 1
+
+
+class VexPageCompressCache:
+    """Flask-Compress cache backend that only keeps the compressed /vex page.
+    
+    API responses change on every request, so they are compressed but never stored.
+    """
+    
+    def __init__(self):
+        self.pages = {}
+    
+    def get(self, key):
+        if request.endpoint != 'vex_page':
+            return None
+        return self.pages.get(key)
+    
+    def set(self, key, value):
+        if request.endpoint != 'vex_page':
+            return
+        if key not in self.pages and len(self.pages) >= VEX_PAGE_CACHE_MAX:
+            self.pages.clear()
+        self.pages[key] = value
+
+
+# The /vex key is the USB state the page was rendered for (set by vex_page)
+app.config['COMPRESS_CACHE_BACKEND'] = VexPageCompressCache
+app.config['COMPRESS_CACHE_KEY'] = lambda req: g.get('vex_page_key', '')
+Compress(app)
+
 # ==================== USB SERIAL FUNCTIONS ====================
+def wake_receivers():
+    """Wake any /api/receive requests waiting for new messages or a USB change."""
+    with new_msg_cond:
+        new_msg_cond.notify_all()
+
+
+def close_serial():
+    """Close the serial port and clear the connection state.
+    
+    Only the receive thread calls this (directly or via setup_serial(); main()
+    also runs setup_serial() before starting it), so the fd the thread has
+    registered for reads is never closed underneath it.
+    """
+    global serial_port, current_usb_port, tx_fd, connected
+    
+    # Taking tx_lock waits out an in-flight write, so TX never uses a closed fd
+    with tx_lock:
+        port = serial_port
+        serial_port = None
+        current_usb_port = None
+        tx_fd = None
+        connected = False
+        if port:
+            try:
+                port.close()
+            except:
+                pass
+
+
 def setup_serial():
     """Set up the USB serial connection. VEX Brain is always the 2nd ttyACM device."""
-    global serial_port, current_usb_port
+    global serial_port, current_usb_port, tx_fd, connected, acm_ports_present
     
     # Close existing connection if any
     if serial_port:
-        try:
-            serial_port.close()
-        except:
-            pass
-        serial_port = None
-        current_usb_port = None
+        close_serial()
     
     # Find available ttyACM ports (VEX Brain is always the 2nd one)
-    acm_ports = sorted(glob.glob('/dev/ttyACM*'))
+    acm_ports = sorted(
+        device.device_node
+        for device in udev_context.list_devices(subsystem='tty', sys_name='ttyACM*')
+        if device.device_node
+    )
     
-    if len(acm_ports) < 2:
+    acm_ports_present = len(acm_ports) >= 2
+    if not acm_ports_present:
         print(f"Found {len(acm_ports)} ttyACM port(s), need at least 2 for VEX Brain.")
         return False
     
@@ -80,106 +176,233 @@ def setup_serial():
             timeout=1
         )
         serial_port.flush()
+        rx_accum.clear()  # Drop any partial line from a previous connection
         current_usb_port = target_port
+        tx_fd = serial_port.fileno()
+        connected = True
         print(f"Connected to {target_port} at {USB_BAUD_RATE} baud.")
         return True
     except Exception as e:
         print(f"Could not open {target_port}: {e}")
         serial_port = None
         current_usb_port = None
+        tx_fd = None
+        connected = False
         return False
 
 
 def serial_receive_thread():
     """Background thread: continuously reads from USB serial with auto-reconnect."""
-    global received_messages, serial_port, current_usb_port, running
+    global msg_top, msg_count, connected, running, rx_accum
     
     message_id = 0
-    last_reconnect_attempt = 0
+    scan_pending = True  # Rescan once right after losing the connection
+    cached_sec = 0         # Second the cached timestamp string was formatted for
+    cached_timestamp = ''
+    
+    # epoll-backed selector: the thread sleeps in the kernel until the tty is readable
+    sel = selectors.DefaultSelector()
+    registered_port = None  # Serial object whose fd is currently registered
+    registered_fd = None
+    
+    # udev pushes tty add/remove events, so an unplugged brain needs no rescans
+    monitor = pyudev.Monitor.from_netlink(udev_context)
+    monitor.filter_by('tty')
+    monitor.start()
     
     while running:
         try:
             # Check if we have a valid connection
-            if serial_port and serial_port.is_open:
+            if connected:
+                if registered_port is not serial_port:
+                    # New connection since the last pass - (re)register its fd
+                    if registered_fd is not None:
+                        sel.unregister(registered_fd)
+                    registered_fd = serial_port.fileno()
+                    sel.register(registered_fd, selectors.EVENT_READ)
+                    registered_port = serial_port
                 try:
-                    if serial_port.in_waiting > 0:
-                        line = serial_port.readline().decode('utf-8', errors='ignore').rstrip()
-                        if line:
+                    # Wait less while a partial line is pending so it still shows up,
+                    # like readline() returning at its timeout
+                    if sel.select(timeout=PARTIAL_LINE_TIMEOUT if rx_accum else RECONNECT_INTERVAL):
+                        if not connected:
+                            continue  # send_to_serial hit an error - close the port below
+                        # Drain everything waiting into the reusable buffer in one syscall
+                        try:
+                            nbytes = os.readv(registered_fd, [RX_VIEW])
+                        except BlockingIOError:
+                            continue  # Spurious wakeup - nothing to read after all
+                        if not nbytes:
+                            raise serial.SerialException('device reports readiness to read but returned no data')
+                        rx_accum += RX_VIEW[:nbytes]
+                        # Decode every complete line in the buffer with one call;
+                        # any trailing partial line stays in rx_accum
+                        end = rx_accum.rfind(b'\n')
+                        if end >= 0:
+                            lines = rx_accum[:end].decode('utf-8', errors='ignore').split('\n')
+                            del rx_accum[:end + 1]
+                        else:
+                            lines = []
+                        if len(rx_accum) >= RX_BUF_SIZE:
+                            # No newline in sight - emit what we have rather than grow forever
+                            lines.append(rx_accum.decode('utf-8', errors='ignore'))
+                            rx_accum.clear()
+                    elif rx_accum:
+                        # Idle with a partial line (e.g. a prompt) - emit it as is
+                        lines = [rx_accum.decode('utf-8', errors='ignore')]
+                        rx_accum.clear()
+                    else:
+                        continue  # Idle - loop back to re-check the connection
+                    
+                    if lines:
+                        top_before = msg_top
+                        # Only reformat when the second ticks over
+                        now_sec = time.time_ns() // 1_000_000_000
+                        if now_sec != cached_sec:
+                            cached_sec = now_sec
+                            cached_timestamp = time.strftime('%H:%M:%S', time.localtime(now_sec))
+                        for line in lines:
+                            line = line.rstrip()
+                            if not line:
+                                continue
                             message_id += 1
-                            timestamp = time.strftime('%H:%M:%S')
-                            with serial_lock:
-                                received_messages.append({
-                                    'id': message_id,
-                                    'text': line,
-                                    'timestamp': timestamp
-                                })
+                            # Fill the slot before publishing it via msg_top
+                            msg_texts[msg_top] = line
+                            msg_timestamps[msg_top] = cached_timestamp
+                            msg_ids[msg_top] = message_id
+                            msg_top = (msg_top + 1) & MSG_RING_MASK
+                            if msg_count < MSG_RING_SIZE:
+                                msg_count += 1
                             print(f"[VEX RX]: {line}")
+                        if msg_top != top_before:
+                            wake_receivers()
                 except (serial.SerialException, OSError) as e:
-                    # Serial port was disconnected
+                    # Serial port was disconnected - closed on the next pass
                     print(f"Serial connection lost: {e}")
-                    try:
-                        serial_port.close()
-                    except:
-                        pass
-                    serial_port = None
-                    current_usb_port = None
+                    connected = False
             else:
-                # No connection - try to reconnect periodically
-                current_time = time.time()
-                if current_time - last_reconnect_attempt >= RECONNECT_INTERVAL:
-                    last_reconnect_attempt = current_time
+                if registered_fd is not None:
+                    sel.unregister(registered_fd)
+                    registered_port = None
+                    registered_fd = None
+                    scan_pending = True
+                    # Drop udev events queued while connected - they would trigger needless rescans
+                    while monitor.poll(timeout=0) is not None:
+                        pass
+                if serial_port is not None:
+                    # Connection dropped here or in send_to_serial; this thread is the
+                    # only one that closes the port, after unregistering its fd above
+                    close_serial()
+                    wake_receivers()
+                # No connection - rescan right away, then only when udev reports a new
+                # ttyACM device. If the ports exist but opening failed (e.g. EBUSY while
+                # ModemManager probes them), also retry every RECONNECT_INTERVAL.
+                if scan_pending:
+                    scan_pending = False
                     print("USB disconnected. Scanning for available ports...")
-                    if setup_serial():
-                        print("USB serial reconnected successfully!")
+                    reconnect = True
+                else:
+                    device = monitor.poll(timeout=RECONNECT_INTERVAL if acm_ports_present else None)
+                    if device is None:
+                        reconnect = True  # Timed out - retry the failed open
+                    else:
+                        reconnect = (device.action == 'add'
+                                     and device.sys_name.startswith('ttyACM'))
+                        if reconnect:
+                            print(f"{device.device_node} appeared. Scanning for available ports...")
+                if reconnect and setup_serial():
+                    print("USB serial reconnected successfully!")
+                    wake_receivers()
                     
         except Exception as e:
             print(f"Serial thread error: {e}")
-        
-        time.sleep(0.05)  # Small delay to prevent CPU spinning
+            time.sleep(0.05)
+    
+    sel.close()
 
 
 def send_to_serial(message):
     """Send a message to the USB serial port."""
-    global serial_port, current_usb_port
+    global connected
     
-    if serial_port and serial_port.is_open:
+    data = message.encode('utf-8') + b"\n"
+    with tx_lock:
+        # close_serial() also takes tx_lock, so tx_fd stays open for this write
+        if not connected or tx_fd is None:
+            return False, "USB serial not connected"
         try:
-            serial_port.write((message + "\n").encode('utf-8'))
-            print(f"[VEX TX]: {message}")
-            return True, "Message sent"
+            # Write straight to the fd - one syscall instead of pyserial's write path
+            while data:
+                try:
+                    written = os.write(tx_fd, data)
+                except BlockingIOError:
+                    # pyserial opens the tty non-blocking; let it wait out a full buffer
+                    serial_port.write(data)
+                    break
+                data = data[written:]
         except (serial.SerialException, OSError) as e:
-            # Connection lost during send
+            # Connection lost during send - the receive thread closes the port
             print(f"Serial send failed, connection lost: {e}")
-            try:
-                serial_port.close()
-            except:
-                pass
-            serial_port = None
-            current_usb_port = None
+            connected = False
             return False, "USB connection lost"
         except Exception as e:
             return False, str(e)
-    else:
-        return False, "USB serial not connected"
+    
+    print(f"[VEX TX]: {message}")
+    return True, "Message sent"
+
+
+# ==================== MESSAGE BUFFER ====================
+def get_new_messages(last_id):
+    """Return buffered messages with id > last_id, oldest first."""
+    # Ids increase with each write, so walk back from the newest slot until
+    # we reach one the client has already seen
+    top = msg_top
+    count = msg_count
+    new_count = 0
+    while new_count < count and msg_ids[(top - new_count - 1) & MSG_RING_MASK] > last_id:
+        new_count += 1
+    
+    return [
+        {'id': msg_ids[i], 'text': msg_texts[i], 'timestamp': msg_timestamps[i]}
+        for i in ((top - new_count + n) & MSG_RING_MASK for n in range(new_count))
+    ]
 
 
 # ==================== ROUTES ====================
+def ojson(obj):
+    """Build a JSON response with orjson (faster than Flask's jsonify)."""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+
 @app.route('/')
 def home():
     """Redirect to /vex page."""
-    return '<html><head><meta http-equiv="refresh" content="0;url=/vex"></head></html>'
+    return redirect('/vex')
 
 
 @app.route('/vex')
 def vex_page():
     """Serve the main VEX communication page."""
-    usb_connected = serial_port is not None and serial_port.is_open
-    return render_template(
-        'vex.html',
-        usb_connected=usb_connected,
-        usb_port=current_usb_port or "N/A",
-        baud_rate=USB_BAUD_RATE
-    )
+    usb_connected = connected
+    usb_port = current_usb_port or "N/A"
+    key = (usb_connected, usb_port)
+    
+    # The page only varies with USB state, so render each state once
+    html = vex_page_cache.get(key)
+    if html is None:
+        html = render_template(
+            'vex.html',
+            usb_connected=usb_connected,
+            usb_port=usb_port,
+            baud_rate=USB_BAUD_RATE
+        )
+        if len(vex_page_cache) >= VEX_PAGE_CACHE_MAX:
+            vex_page_cache.clear()
+        vex_page_cache[key] = html
+    
+    g.vex_page_key = f"{usb_connected}|{usb_port}"  # Lets Flask-Compress reuse its gzip
+    return Response(html, mimetype='text/html')
 
 
 @app.route('/api/send', methods=['POST'])
@@ -189,43 +412,76 @@ def api_send():
     message = data.get('message', '')
     
     if not message:
-        return jsonify({'status': 'error', 'message': 'Empty message'})
+        return ojson({'status': 'error', 'message': 'Empty message'})
     
     success, msg = send_to_serial(message)
     
     if success:
-        return jsonify({'status': 'ok', 'message': msg})
+        return ojson({'status': 'ok', 'message': msg})
     else:
-        return jsonify({'status': 'error', 'message': msg})
+        return ojson({'status': 'error', 'message': msg})
 
 
 @app.route('/api/receive', methods=['GET'])
 def api_receive():
-    """Get received messages from USB serial."""
+    """Get received messages from USB serial (long-poll).
+    
+    If nothing newer than last_id is buffered, wait up to LONG_POLL_TIMEOUT
+    seconds for a message or USB status change before answering.
+    """
+    global idle_receive_cache
+    
     last_id = int(request.args.get('last_id', 0))
     
-    with serial_lock:
-        new_messages = [msg for msg in received_messages if msg['id'] > last_id]
+    top = msg_top
+    port = current_usb_port
+    new_messages = get_new_messages(last_id)
+    
+    if not new_messages:
+        with new_msg_cond:
+            new_msg_cond.wait_for(
+                lambda: msg_top != top or current_usb_port != port,
+                timeout=LONG_POLL_TIMEOUT
+            )
+        new_messages = get_new_messages(last_id)
+    
+    usb_connected = connected
+    usb_port = current_usb_port or "N/A"
     
-    usb_connected = serial_port is not None and serial_port.is_open
+    if not new_messages:
+        # Idle reply only depends on USB state - reuse the serialized body
+        key = (usb_connected, usb_port)
+        if idle_receive_cache[0] != key:
+            idle_receive_cache = (key, orjson.dumps({
+                'messages': [],
+                'usb_connected': usb_connected,
+                'usb_port': usb_port
+            }))
+        return Response(idle_receive_cache[1], mimetype='application/json')
     
-    return jsonify({
+    return ojson({
         'messages': new_messages,
         'usb_connected': usb_connected,
-        'usb_port': current_usb_port or "N/A"
+        'usb_port': usb_port
     })
 
 
 @app.route('/api/status', methods=['GET'])
 def api_status():
     """Return server and USB status."""
-    usb_connected = serial_port is not None and serial_port.is_open
-    return jsonify({
-        'status': 'ok',
-        'usb_connected': usb_connected,
-        'usb_port': current_usb_port or "N/A",
-        'baud_rate': USB_BAUD_RATE
-    })
+    global status_cache
+    
+    usb_connected = connected
+    usb_port = current_usb_port or "N/A"
+    key = (usb_connected, usb_port)
+    if status_cache[0] != key:
+        status_cache = (key, orjson.dumps({
+            'status': 'ok',
+            'usb_connected': usb_connected,
+            'usb_port': usb_port,
+            'baud_rate': USB_BAUD_RATE
+        }))
+    return Response(status_cache[1], mimetype='application/json')
 
 
 # ==================== UTILITY FUNCTIONS ====================
@@ -275,13 +531,14 @@ def main():
     print()
     print("-" * 60)
     
-    # Run Flask HTTP server
+    # Run Flask app under waitress (pooled worker threads, not the dev server)
     try:
-        app.run(
+        serve(
+            app,
             host=HOST,
             port=PORT,
-            debug=False,
-            threaded=True
+            threads=WEB_THREADS,
+            channel_timeout=30
         )
     except KeyboardInterrupt:
         print("\nShutting down...")